@@ -1,18 +1,30 @@
+import errno
+import hashlib
+import heapq
+import itertools
+import mimetypes
+import mmap
 import os
 import re
 import shutil
+import struct
 import tempfile
 import zipfile
 import uuid
-import json
+import zlib
+import queue
 import threading
-import time
-from time import time as now
+from concurrent.futures import ThreadPoolExecutor
+from time import localtime, time as now
+from urllib.parse import parse_qs, quote, urlparse
+import orjson
+from diskcache import Cache
 from flask import (
     Flask, request, jsonify, send_file, after_this_request,
-    render_template_string, Response, stream_with_context
+    Response, stream_with_context
 )
 from yt_dlp import YoutubeDL
+from zipstream import ZipStream
 
 API_KEY = os.environ.get('API_KEY')  # Optional: set API key
 
@@ -22,51 +34,568 @@ app = Flask(__name__)
 # Configuration
 # -----------------------
 AUTO_CLEANUP_SECONDS = 10 * 60  # 10 minutes
+AUDIO_EXTS = ('.mp3', '.m4a', '.opus', '.webm', '.ogg')
+PLAYLIST_WORKERS = 4  # concurrent per-entry downloads for playlists
+# libmp3lame encodes on one thread; extra threads only help decoding, and
+# MAX_JOBS x PLAYLIST_WORKERS encoders may already be running at once
+FFMPEG_THREADS = min(4, os.cpu_count() or 2)
+PROGRESS_INTERVAL = 0.2  # min seconds between progress events per download
+META_CACHE_SECONDS = 60 * 60  # cached extract_info results
+META_ERROR_SECONDS = 60  # cached extraction failures
+MAX_JOBS = int(os.environ.get('YTMP3_MAX_JOBS', max(2, (os.cpu_count() or 2) // 2)))
+BUSY_RETRY_AFTER = 30  # seconds, sent with 503 when MAX_JOBS are running
+WORK_ROOT = os.environ.get('YTMP3_WORK', '/dev/shm/ytmp3')  # tmpfs-backed workspaces
+WORK_MIN_FREE = 500 * 1024 * 1024  # fall back to the disk temp dir below this
+
+# Let the front web server send finished files instead of Python:
+#   'x-sendfile' - Apache/lighttpd X-Sendfile
+#   'x-accel'    - nginx X-Accel-Redirect, with e.g.
+#                  location /_protected/ { internal; alias /dev/shm/ytmp3/; }
+SENDFILE_MODE = os.environ.get('YTMP3_SENDFILE', '').lower()
+if SENDFILE_MODE not in ('', 'x-sendfile', 'x-accel'):
+    raise RuntimeError(f"YTMP3_SENDFILE must be 'x-sendfile' or 'x-accel', got {SENDFILE_MODE!r}")
+ACCEL_PREFIX = os.environ.get('YTMP3_ACCEL_PREFIX', '/_protected/')
+app.config['USE_X_SENDFILE'] = SENDFILE_MODE == 'x-sendfile'
 
 # -----------------------
-# In-memory job registry (token -> {path, filename, expires_at})
+# yt-dlp metadata cache (video/playlist id -> info dict), shared across processes
+# -----------------------
+META_CACHE = Cache(os.environ.get('YTMP3_META_CACHE', '.meta_cache'))
+
+# -----------------------
+# yt-dlp options, built once; build_opts() adds the per-job outtmpl
+# -----------------------
+YDL_OPTS_BASE = {
+    'format': 'bestaudio[ext=m4a]/bestaudio',
+    'keepvideo': False,
+    'quiet': True,
+    'no_warnings': True,
+    'logger': app.logger,
+    'nocheckcertificate': True,
+}
+YDL_OPTS_MP3 = dict(
+    YDL_OPTS_BASE,
+    format='bestaudio[ext=m4a]/bestaudio/best',
+    postprocessors=[
+        {
+            'key': 'FFmpegExtractAudio',
+            'preferredcodec': 'mp3',
+            'preferredquality': '192',
+        }
+    ],
+    # keyed by the postprocessor's pp_key(), in lower case
+    postprocessor_args={
+        'extractaudio': ['-threads', str(FFMPEG_THREADS)],
+    },
+)
+
+# Long-lived instances for metadata-only lookups, so extractor setup is paid
+# once per instance rather than per request. YoutubeDL isn't thread-safe, so
+# each lookup checks one out of the pool (or makes one) and returns it after.
+# Shares YDL_OPTS_BASE's network settings (nocheckcertificate etc.) with the
+# download instances; only format selection is left to the downloader.
+YDL_OPTS_META = dict(
+    {k: v for k, v in YDL_OPTS_BASE.items() if k != 'format'},
+    extract_flat='in_playlist',
+    skip_download=True,
+)
+_META_POOL = queue.Queue(maxsize=4)  # idle instances
+
+
+def _checkout_meta_ydl() -> YoutubeDL:
+    try:
+        return _META_POOL.get_nowait()
+    except queue.Empty:
+        return YoutubeDL(YDL_OPTS_META)
+
+
+def _checkin_meta_ydl(ydl: YoutubeDL):
+    try:
+        _META_POOL.put_nowait(ydl)
+    except queue.Full:
+        ydl.close()
+
+
+# -----------------------
+# In-memory job registry
+# (token -> {dir, path | files, filename, is_playlist, refs, active, expires_at})
 # For a single-server development environment only.
 # -----------------------
 JOBS = {}
 JOB_LOCK = threading.Lock()
+JOB_SEM = threading.BoundedSemaphore(MAX_JOBS)  # running yt-dlp/FFmpeg jobs
+
+
+# -----------------------
+# Delayed cleanup: one daemon thread runs callbacks from a min-heap of
+# (run_at, seq, fn) instead of one threading.Timer thread per job.
+# -----------------------
+_CLEANUP_HEAP = []
+_CLEANUP_COND = threading.Condition()
+_CLEANUP_SEQ = itertools.count()  # tie-breaker so fns are never compared
+_cleanup_thread = None
+
+
+def schedule_cleanup(fn, delay: float = 0):
+    global _cleanup_thread
+    with _CLEANUP_COND:
+        heapq.heappush(_CLEANUP_HEAP, (now() + delay, next(_CLEANUP_SEQ), fn))
+        if _cleanup_thread is None:
+            # started lazily so it lives in the serving process, not a pre-fork parent
+            _cleanup_thread = threading.Thread(target=_cleanup_loop, name='cleanup', daemon=True)
+            _cleanup_thread.start()
+        _CLEANUP_COND.notify()
+
+
+def _cleanup_loop():
+    while True:
+        with _CLEANUP_COND:
+            while not _CLEANUP_HEAP:
+                _CLEANUP_COND.wait()
+            run_at, _, fn = _CLEANUP_HEAP[0]
+            wait_s = run_at - now()
+            if wait_s > 0:
+                _CLEANUP_COND.wait(timeout=wait_s)
+                continue
+            heapq.heappop(_CLEANUP_HEAP)
+        try:
+            fn()
+        except Exception:
+            app.logger.exception("cleanup task failed")
+
+
+def make_workdir() -> str:
+    """Create a per-job directory, on tmpfs (WORK_ROOT) when it has room."""
+    try:
+        os.makedirs(WORK_ROOT, exist_ok=True)
+        if shutil.disk_usage(WORK_ROOT).free >= WORK_MIN_FREE:
+            return tempfile.mkdtemp(prefix='ydl_', dir=WORK_ROOT)
+    except OSError:
+        app.logger.warning("work root %s unavailable, using disk temp dir", WORK_ROOT)
+    return tempfile.mkdtemp(prefix='ydl_')
+
+
+def remove_workdir(path: str, delay: float = 0):
+    """Delete a job directory in the background, off the request path."""
+    def _remove():
+        forget_crc32(path)
+        shutil.rmtree(path, ignore_errors=True)
+
+    schedule_cleanup(_remove, delay)
 
 
 def schedule_job_cleanup(token: str, delay: int = AUTO_CLEANUP_SECONDS):
     def _cleanup():
         with JOB_LOCK:
             job = JOBS.pop(token, None)
+            if job:
+                # no further downloads; a download still streaming the files
+                # removes the dir itself when it finishes (see download_token)
+                job['refs'] = 0
+                if job.get('active', 0) > 0:
+                    app.logger.info("Job %s expired mid-download; cleanup deferred", token)
+                    return
         if job:
             try:
-                shutil.rmtree(os.path.dirname(job['path']), ignore_errors=True)
+                shutil.rmtree(job['dir'], ignore_errors=True)
                 app.logger.info("Auto-cleaned job %s", token)
             except Exception:
                 app.logger.exception("Error cleaning job %s", token)
 
-    t = threading.Timer(delay, _cleanup)
-    t.daemon = True
-    t.start()
+    schedule_cleanup(_cleanup, delay)
 
 
 # -----------------------
 # Utilities
 # -----------------------
+_YT_RE = re.compile(
+    r'^(?:https?://)?(?:www\.|m\.|music\.)?(?:youtube\.com/(?:watch|playlist)|youtu\.be/)', re.I
+)
+_BAD = re.compile(r'[\\/:*?"<>|]+')
+_WS = re.compile(r'\s+')
+
+
 def is_youtube_url(url: str) -> bool:
-    if not url:
-        return False
-    url = url.lower()
-    return 'youtube.com/watch' in url or 'youtube.com/playlist' in url or 'youtu.be/' in url
+    return bool(url) and _YT_RE.match(url) is not None
 
 
 def sanitize_filename(name: str, max_length: int = 200) -> str:
     if not name:
         return "untitled"
-    name = re.sub(r'[\\/:*?"<>|]+', '', name)
-    name = re.sub(r'\s+', ' ', name).strip()
+    name = _BAD.sub('', name)
+    name = _WS.sub(' ', name).strip()
     if len(name) > max_length:
         name = name[:max_length].rstrip()
     return name or "untitled"
 
 
+def build_opts(tempdir: str, want_mp3: bool = True) -> dict:
+    """yt-dlp options for an audio-only download into tempdir.
+
+    With want_mp3 the best audio stream is transcoded to MP3 by FFmpeg;
+    otherwise the native m4a/opus stream is kept as-is and no re-encode
+    happens at all.
+    """
+    opts = (YDL_OPTS_MP3 if want_mp3 else YDL_OPTS_BASE).copy()
+    opts['outtmpl'] = os.path.join(tempdir, '%(title)s.%(ext)s')
+    return opts
+
+
+def audio_ext(info: dict, want_mp3: bool) -> str:
+    """File extension (with dot) yt-dlp produced for info."""
+    if want_mp3:
+        return '.mp3'
+    return '.' + (info.get('ext') or 'm4a')
+
+
+def parse_want_mp3(value):
+    """Map the ?format= query flag to want_mp3; None if unsupported."""
+    value = (value or 'mp3').lower()
+    if value == 'mp3':
+        return True
+    if value in ('m4a', 'native'):
+        return False
+    return None
+
+
+def list_audio(directory: str) -> list:
+    """Names of the audio files directly inside directory."""
+    with os.scandir(directory) as it:
+        return [e.name for e in it if e.name.lower().endswith(AUDIO_EXTS) and e.is_file()]
+
+
+def find_audio(directory: str, title: str, ext: str):
+    """Locate the audio file yt-dlp wrote for title in directory, or None.
+
+    The directory is listed once and every candidate is resolved from that
+    listing (no per-candidate stat calls).
+    """
+    mp3s = list_audio(directory)
+    if not mp3s:
+        return None
+    exact = f"{title}{ext}"
+    if len(mp3s) == 1 or exact in mp3s:
+        match = exact if exact in mp3s else mp3s[0]
+    else:
+        match = next((f for f in mp3s if title in f), mp3s[0])
+    return os.path.join(directory, match)
+
+
+_ID_RE = re.compile(r'[?&]list=([\w-]+)|[?&]v=([\w-]{11})|youtu\.be/([\w-]{11})')
+
+
+def extract_id(url: str):
+    """Canonical cache key for a YouTube url ('list:<id>' / 'video:<id>'), or None.
+
+    A watch url carrying a list= parameter is treated as the playlist, which
+    is what yt-dlp downloads for it.
+    """
+    playlist_id = video_id = None
+    for m in _ID_RE.finditer(url or ''):
+        playlist_id = playlist_id or m.group(1)
+        video_id = video_id or m.group(2) or m.group(3)
+    if playlist_id:
+        return f"list:{playlist_id}"
+    if video_id:
+        return f"video:{video_id}"
+    return None
+
+
+def _extract_unprocessed(ydl: YoutubeDL, url: str) -> dict:
+    info = ydl.extract_info(url, download=False, process=False)
+    while info.get('_type') in ('url', 'url_transparent'):
+        info = ydl.extract_info(info['url'], download=False, ie_key=info.get('ie_key'), process=False)
+    if info.get('_type') in ('playlist', 'multi_video'):
+        # flatten the entries into a list (extract_flat keeps them as url stubs)
+        info = ydl.process_ie_result(info, download=False)
+    return info
+
+
+def get_info(url: str, refresh: bool = False) -> dict:
+    """extract_info(url, download=False) with playlists left flat, cached by id.
+
+    Single videos are cached unprocessed (no format selected yet), so the
+    downloading YoutubeDL's own format choice applies in process_ie_result.
+    Failures are cached for META_ERROR_SECONDS so a bad url isn't retried
+    against YouTube on every request.
+    """
+    key = extract_id(url)
+    if key and not refresh:
+        cached = META_CACHE.get(key)
+        if cached is not None:
+            if 'error' in cached:
+                raise RuntimeError(cached['error'])
+            return cached['info']
+
+    try:
+        ydl = _checkout_meta_ydl()
+        try:
+            info = YoutubeDL.sanitize_info(_extract_unprocessed(ydl, url))
+        finally:
+            _checkin_meta_ydl(ydl)
+    except Exception as exc:
+        if key:
+            META_CACHE.set(key, {'error': str(exc)}, expire=META_ERROR_SECONDS)
+        raise
+    if key:
+        META_CACHE.set(key, {'info': info}, expire=META_CACHE_SECONDS)
+    return info
+
+
+def streams_fresh(info: dict, margin: int = 60) -> bool:
+    """True if the signed stream urls in a video info dict are still valid."""
+    expires = []
+    for fmt in info.get('formats') or []:
+        qs = parse_qs(urlparse(fmt.get('url') or '').query)
+        if 'expire' in qs:
+            expires.append(int(qs['expire'][0]))
+    return bool(expires) and min(expires) > now() + margin
+
+
+def download_audio(url: str, tempdir: str, want_mp3: bool, make_hook=None, on_playlist=None):
+    """Download url as audio into tempdir; returns (info, [audio paths]).
+
+    Playlists are enumerated flat first and their entries downloaded by a
+    pool of single-item YoutubeDL workers (one subdir each), so the network
+    download of one entry overlaps the FFmpeg encode of another.
+    make_hook(entry_idx) builds a progress hook (entry_idx is None for a
+    single video); on_playlist(entries) is called once entries are known.
+    """
+    info = get_info(url)
+
+    if info.get('_type') != 'playlist':
+        if not streams_fresh(info):
+            info = get_info(url, refresh=True)
+        opts = build_opts(tempdir, want_mp3)
+        if make_hook:
+            opts['progress_hooks'] = [make_hook(None)]
+        with YoutubeDL(opts) as ydl:
+            info = ydl.process_ie_result(info, download=True)
+        title = sanitize_filename(info.get('title') or info.get('id') or 'video')
+        path = find_audio(tempdir, title, audio_ext(info, want_mp3))
+        if not path:
+            raise RuntimeError("expected audio file not found after download")
+        return info, [path]
+
+    entries = [e for e in info.get('entries') or [] if e]
+    if not entries:
+        raise RuntimeError("playlist has no entries")
+    if on_playlist:
+        on_playlist(entries)
+
+    def _download_entry(idx, entry):
+        entry_dir = os.path.join(tempdir, str(idx))
+        os.makedirs(entry_dir, exist_ok=True)
+        opts = build_opts(entry_dir, want_mp3)
+        if make_hook:
+            opts['progress_hooks'] = [make_hook(idx)]
+        with YoutubeDL(opts) as ydl:
+            ydl.download([entry.get('url') or entry['id']])
+        entry_title = sanitize_filename(entry.get('title') or entry.get('id') or 'untitled')
+        path = find_audio(entry_dir, entry_title, audio_ext(entry, want_mp3))
+        if path and SENDFILE_MODE:
+            # the zip will be assembled by write_stored_zip; checksum the file now,
+            # while it's hot in the page cache and other entries are still downloading
+            remember_crc32(path)
+        return path
+
+    with ThreadPoolExecutor(max_workers=min(PLAYLIST_WORKERS, len(entries))) as pool:
+        paths = list(pool.map(_download_entry, range(len(entries)), entries))
+    return info, [p for p in paths if p]
+
+
+def zip_response(files, download_name: str) -> Response:
+    """Stream files as a zip built on the fly (nothing is written to disk).
+
+    Audio is already compressed, so entries are stored rather than deflated;
+    Zip64 records are added automatically once the archive needs them.
+    """
+    zs = ZipStream(compress_type=zipfile.ZIP_STORED, sized=True)
+    for path in files:
+        zs.add_path(path, arcname=os.path.basename(path), compress_type=zipfile.ZIP_STORED)
+    response = Response(zs, mimetype='application/zip')
+    response.headers['Content-Length'] = str(len(zs))
+    set_attachment(response, download_name)
+    return response
+
+
+# Zip record layouts (PKWARE APPNOTE 4.3.7, 4.3.12, 4.3.16), without Zip64
+_ZIP_LOCAL = struct.Struct('<4s5H3I2H')
+_ZIP_CENTRAL = struct.Struct('<4s6H3I5H2I')
+_ZIP_END = struct.Struct('<4s4H2IH')
+_ZIP_LIMIT = 0xFFFFFFFF
+_ZIP_UTF8 = 0x800  # general purpose flag: names are UTF-8
+
+
+def file_crc32(path: str) -> int:
+    """CRC-32 of a file via one pass over an mmap (zlib drops the GIL for it)."""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return zlib.crc32(mm)
+
+
+# CRC-32s taken right after each playlist entry finishes, so zip assembly
+# doesn't need another pass over the data: path -> (size, mtime_ns, crc)
+CRC_CACHE = {}
+CRC_LOCK = threading.Lock()
+
+
+def remember_crc32(path: str):
+    st = os.stat(path)
+    crc = file_crc32(path)
+    with CRC_LOCK:
+        CRC_CACHE[path] = (st.st_size, st.st_mtime_ns, crc)
+
+
+def cached_crc32(path: str, st: os.stat_result) -> int:
+    """CRC-32 from CRC_CACHE if the file is unchanged since, else computed now."""
+    with CRC_LOCK:
+        cached = CRC_CACHE.pop(path, None)
+    if cached and cached[:2] == (st.st_size, st.st_mtime_ns):
+        return cached[2]
+    return file_crc32(path)
+
+
+def forget_crc32(directory: str):
+    """Drop CRC_CACHE entries for files under directory."""
+    prefix = os.path.join(directory, '')
+    with CRC_LOCK:
+        for path in [p for p in CRC_CACHE if p.startswith(prefix)]:
+            del CRC_CACHE[path]
+
+
+def _splice(out_fd: int, src, size: int):
+    """Copy size bytes of src to out_fd, kernel-side with os.sendfile when possible."""
+    sent = 0
+    while sent < size:
+        try:
+            n = os.sendfile(out_fd, src.fileno(), sent, size - sent)
+        except OSError as exc:
+            # e.g. platforms where sendfile needs a socket; copy the rest in Python
+            if exc.errno not in (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK, errno.EOPNOTSUPP):
+                raise
+            src.seek(sent)
+            remaining = size - sent
+            with os.fdopen(os.dup(out_fd), 'wb') as out:
+                while remaining:
+                    chunk = src.read(min(remaining, 1024 * 1024))
+                    if not chunk:
+                        raise OSError(f"unexpected end of file copying {src.name}")
+                    out.write(chunk)
+                    remaining -= len(chunk)
+            return
+        if n == 0:
+            raise OSError(f"unexpected end of file copying {src.name}")
+        sent += n
+
+
+def write_stored_zip(zip_path: str, files) -> bool:
+    """Write an uncompressed zip of files to zip_path.
+
+    Headers are packed here and each member body is spliced into the archive
+    with os.sendfile, so the audio data never passes through Python; CRCs
+    come from CRC_CACHE when download_audio already computed them. Returns
+    False without writing anything if the archive would need Zip64 records.
+    """
+    members = []
+    offset = 0
+    for path in files:
+        st = os.stat(path)
+        name = os.path.basename(path).encode('utf-8')
+        t = localtime(st.st_mtime)
+        dos_time = t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2
+        dos_date = max(t.tm_year - 1980, 0) << 9 | t.tm_mon << 5 | t.tm_mday
+        members.append((path, name, st.st_size, offset, dos_time, dos_date, cached_crc32(path, st)))
+        offset += _ZIP_LOCAL.size + len(name) + st.st_size
+    central_size = sum(_ZIP_CENTRAL.size + len(m[1]) for m in members)
+    if len(members) > 0xFFFF or offset + central_size > _ZIP_LIMIT:
+        return False
+
+    central = []
+    with open(zip_path, 'wb', buffering=0) as out:
+        for path, name, size, header_offset, dos_time, dos_date, crc in members:
+            out.write(_ZIP_LOCAL.pack(b'PK\x03\x04', 20, _ZIP_UTF8, zipfile.ZIP_STORED,
+                                      dos_time, dos_date, crc, size, size, len(name), 0) + name)
+            with open(path, 'rb') as src:
+                _splice(out.fileno(), src, size)
+            central.append(_ZIP_CENTRAL.pack(b'PK\x01\x02', 3 << 8 | 20, 20, _ZIP_UTF8,
+                                             zipfile.ZIP_STORED, dos_time, dos_date, crc, size, size,
+                                             len(name), 0, 0, 0, 0, 0o100644 << 16, header_offset) + name)
+        out.write(b''.join(central))
+        out.write(_ZIP_END.pack(b'PK\x05\x06', 0, 0, len(members), len(members),
+                                central_size, offset, 0))
+    return True
+
+
+def prebuilt_zip(tempdir: str, files, download_name: str):
+    """Assemble the playlist zip in tempdir when a front server will send it.
+
+    Returns its path, or None if the zip should be streamed by zip_response.
+    """
+    if not SENDFILE_MODE:
+        return None
+    zip_path = os.path.join(tempdir, download_name)
+    if not write_stored_zip(zip_path, files):
+        return None
+    return zip_path
+
+
+def set_attachment(response: Response, download_name: str):
+    """Content-Disposition: attachment, RFC 2231-encoding non-ASCII names."""
+    try:
+        download_name.encode('ascii')
+        names = {'filename': download_name}
+    except UnicodeEncodeError:
+        names = {
+            'filename': download_name.encode('ascii', 'ignore').decode('ascii') or 'download',
+            'filename*': f"UTF-8''{quote(download_name, safe='')}",
+        }
+    response.headers.set('Content-Disposition', 'attachment', **names)
+
+
+def file_response(path: str, download_name: str, mimetype=None) -> Response:
+    """send_file, or an X-Accel-Redirect for nginx when SENDFILE_MODE is 'x-accel'.
+
+    Files outside WORK_ROOT (the disk fallback) can't be mapped to the
+    internal location and are sent by Python.
+    """
+    rel = os.path.relpath(path, WORK_ROOT)
+    if SENDFILE_MODE != 'x-accel' or rel.startswith('..'):
+        return send_file(path, as_attachment=True, download_name=download_name, mimetype=mimetype)
+    mimetype = mimetype or mimetypes.guess_type(download_name)[0] or 'application/octet-stream'
+    response = Response(status=200, mimetype=mimetype)
+    response.headers['X-Accel-Redirect'] = quote(ACCEL_PREFIX + rel)
+    set_attachment(response, download_name)
+    return response
+
+
+def cleanup_after(response: Response, path: str, is_last=None) -> Response:
+    """Remove the job directory path once response no longer needs it.
+
+    The zip body is streamed lazily, so removal waits for the response to
+    close. Files handed to the front server are read after we return, so
+    those are left to the timed AUTO_CLEANUP_SECONDS removal instead.
+    Anything else (send_file, errors) is removed right away: send_file has
+    already opened its file, and werkzeug never calls close callbacks for
+    its passthrough body.
+    If given, is_last() is called once this response is finished with path
+    and the directory is only removed when it returns True.
+    """
+    if 'X-Accel-Redirect' in response.headers or 'X-Sendfile' in response.headers:
+        if is_last is None or is_last():
+            remove_workdir(path, delay=AUTO_CLEANUP_SECONDS)
+    elif isinstance(response.response, ZipStream):
+        def _on_close():
+            if is_last is None or is_last():
+                remove_workdir(path)
+        response.call_on_close(_on_close)
+    elif is_last is None or is_last():
+        remove_workdir(path)
+    return response
+
+
 # -----------------------
 # Professional HTML front-end (uses SSE)
 # -----------------------
@@ -171,6 +700,8 @@ HTML_PAGE = """
   const bar = document.getElementById('bar');
   const downloadArea = document.getElementById('downloadArea');
   let es = null;
+  let entryCount = 0;
+  let entryPct = {};
 
   function addMsg(text) {
     const el = document.createElement('div'); el.className = 'msg'; el.textContent = text;
@@ -183,6 +714,8 @@ HTML_PAGE = """
     bar.style.width = '0%';
     statusText.textContent = 'Idle';
     downloadArea.innerHTML = '';
+    entryCount = 0;
+    entryPct = {};
     if (es) { es.close(); es = null; }
   }
 
@@ -204,8 +737,14 @@ HTML_PAGE = """
     es.addEventListener('progress', (ev) => {
       try {
         const data = JSON.parse(ev.data);
+        if (data.entries != null) entryCount = data.entries;
         if (data.percent != null && !isNaN(data.percent)) {
-          const pct = Math.min(100, Math.max(0, data.percent));
+          let pct = Math.min(100, Math.max(0, data.percent));
+          if (data.entry_idx != null && entryCount) {
+            // playlist entries download concurrently; show the average
+            entryPct[data.entry_idx] = pct;
+            pct = Object.values(entryPct).reduce((a, b) => a + b, 0) / entryCount;
+          }
           bar.style.width = pct + '%';
           statusText.textContent = `Downloading — ${pct.toFixed(1)}%`;
         } else if (data.status) {
@@ -263,6 +802,182 @@ HTML_PAGE = """
 </html>
 """
 
+# The page has no template variables; encode it and its ETag once at import.
+_INDEX_BODY = HTML_PAGE.encode('utf-8')
+_INDEX_ETAG = hashlib.md5(_INDEX_BODY).hexdigest()
+
+
+# -----------------------
+# SSE download jobs ("flights")
+# Concurrent /progress requests for the same video/playlist and format share
+# one download: each client subscribes its own queue to the running flight
+# and every event is fanned out to all subscriber queues.
+# -----------------------
+IN_FLIGHT = {}  # flight key -> flight, guarded by JOB_LOCK
+# Download workers are reused rather than spawned per request: up to MAX_JOBS
+# daemon threads (so a running job never blocks shutdown) take tasks from
+# _JOB_TASKS. JOB_SEM bounds running jobs, so a task waits at most for the
+# previous job's thread to return after releasing its slot.
+_JOB_TASKS = queue.Queue()
+_job_threads = []
+_JOB_THREADS_LOCK = threading.Lock()
+
+
+def _job_worker():
+    while True:
+        fn, args = _JOB_TASKS.get()
+        try:
+            fn(*args)
+        except Exception:
+            app.logger.exception("job worker task failed")
+
+
+def submit_job(fn, *args):
+    """Run fn(*args) on the job thread pool, starting a thread if below MAX_JOBS."""
+    with _JOB_THREADS_LOCK:
+        if len(_job_threads) < MAX_JOBS:
+            t = threading.Thread(target=_job_worker, name=f'job-{len(_job_threads)}', daemon=True)
+            t.start()
+            _job_threads.append(t)
+    _JOB_TASKS.put((fn, args))
+
+
+def sse_event(name: str, data) -> bytes:
+    return b"event: " + name.encode() + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+
+
+def flight_key(url: str, want_mp3: bool):
+    """IN_FLIGHT key for url in the requested format, or None if not dedupable."""
+    key = extract_id(url)
+    if not key:
+        return None
+    return f"{key}:{'mp3' if want_mp3 else 'native'}"
+
+
+def new_flight() -> dict:
+    return {
+        'token': str(uuid.uuid4()),
+        'subscribers': [],
+        'intro': [],  # events replayed to late subscribers
+        'done_evt': threading.Event(),
+        'result': {'success': False, 'final_path': None, 'final_name': None, 'error': None},
+    }
+
+
+def subscribe(flight: dict) -> queue.Queue:
+    """Attach a new subscriber queue to flight; caller holds JOB_LOCK."""
+    subq = queue.Queue()
+    for evt in flight['intro']:
+        subq.put(evt)
+    flight['subscribers'].append(subq)
+    return subq
+
+
+def push_event(flight: dict, name: str, data, intro: bool = False):
+    evt = sse_event(name, data)
+    if intro:
+        flight['intro'].append(evt)
+    for subq in list(flight['subscribers']):
+        subq.put(evt)
+
+
+def make_progress_hook(flight: dict, entry_idx=None):
+    # coalesce ticks: emit at most every PROGRESS_INTERVAL, keeping only the latest
+    last_emit_ts = [0.0]
+    pending_progress = [None]
+
+    def progress_hook(d):
+        try:
+            status = d.get('status')
+            if status == 'downloading':
+                total = d.get('total_bytes') or d.get('total_bytes_estimate') or 0
+                downloaded = d.get('downloaded_bytes') or 0
+                percent = (downloaded / total * 100) if total else None
+                evt = {
+                    'status': 'downloading',
+                    'percent': percent,
+                    'speed': d.get('speed'),
+                    'eta': d.get('eta'),
+                    'filename': d.get('filename')
+                }
+                if entry_idx is not None:
+                    evt['entry_idx'] = entry_idx
+                pending_progress[0] = evt
+                if now() - last_emit_ts[0] > PROGRESS_INTERVAL:
+                    push_event(flight, 'progress', evt)
+                    pending_progress[0] = None
+                    last_emit_ts[0] = now()
+            elif status == 'finished':
+                if pending_progress[0] is not None:
+                    push_event(flight, 'progress', pending_progress[0])
+                    pending_progress[0] = None
+                push_event(flight, 'progress', {'status': 'download finished, converting...'})
+        except Exception:
+            app.logger.exception("progress_hook error")
+    return progress_hook
+
+
+def run_download(flight: dict, key, url: str, want_mp3: bool):
+    """Worker thread body for a flight; owns one JOB_SEM slot."""
+    result = flight['result']
+    tempdir = None
+
+    def on_playlist(entries):
+        push_event(flight, 'progress', {'status': f'playlist with {len(entries)} entries',
+                                        'entries': len(entries)}, intro=True)
+
+    try:
+        tempdir = make_workdir()
+        info, files = download_audio(url, tempdir, want_mp3,
+                                     lambda idx: make_progress_hook(flight, idx), on_playlist)
+
+        # Prepare final deliverable
+        # the playlist zip is built on the fly by /download, unless the front
+        # server will send it, in which case it's assembled here (no path: stream)
+        is_playlist = info.get('_type') == 'playlist'
+        if is_playlist:
+            playlist_title = sanitize_filename(info.get('title') or 'playlist')
+            final_name = f"{playlist_title}.zip"
+            final_path = prebuilt_zip(tempdir, files, final_name)
+        else:
+            final_path = files[0]
+            final_name = os.path.basename(final_path)
+
+        # register job; closing the flight in the same critical section fixes
+        # the subscriber count, which becomes the number of allowed downloads
+        with JOB_LOCK:
+            IN_FLIGHT.pop(key, None)
+            JOBS[flight['token']] = {
+                'dir': tempdir,
+                'path': final_path,
+                'files': files,
+                'filename': final_name,
+                'is_playlist': is_playlist,
+                'refs': max(1, len(flight['subscribers'])),
+                'active': 0,
+                'expires_at': now() + AUTO_CLEANUP_SECONDS,
+            }
+        schedule_job_cleanup(flight['token'])
+
+        result['success'] = True
+        result['final_path'] = final_path
+        result['final_name'] = final_name
+
+    except Exception as exc:
+        app.logger.exception("SSE download error")
+        result['error'] = str(exc)
+        # cleanup tempdir on failure
+        if tempdir:
+            remove_workdir(tempdir)
+    finally:
+        with JOB_LOCK:
+            IN_FLIGHT.pop(key, None)
+        JOB_SEM.release()
+        flight['done_evt'].set()
+        # Wake the subscribers so they can observe the finished state
+        for subq in list(flight['subscribers']):
+            subq.put(None)
+
 
 # -----------------------
 # SSE endpoint (/progress)
@@ -285,148 +1000,59 @@ def progress_sse():
     if not is_youtube_url(url):
         return jsonify({'error': 'unsupported url domain'}), 400
 
-    def sse_event(name: str, data):
-        payload = json.dumps(data)
-        return f"event: {name}\ndata: {payload}\n\n"
+    want_mp3 = parse_want_mp3(request.args.get('format'))
+    if want_mp3 is None:
+        return jsonify({'error': 'unsupported format (use mp3 or m4a)'}), 400
 
-    def generate():
-        tempdir = tempfile.mkdtemp(prefix='ydl_')
-        token = str(uuid.uuid4())
-
-        # queue for events
-        event_queue = []
-        queue_lock = threading.Lock()
-        finished = {'done': False}  # mutable flag
-        result = {'success': False, 'final_path': None, 'final_name': None, 'error': None}
-
-        # yt-dlp options
-        ydl_opts_base = {
-            'format': 'bestaudio/best',
-            'outtmpl': os.path.join(tempdir, '%(title)s.%(ext)s'),
-            'quiet': True,
-            'no_warnings': True,
-            'postprocessors': [
-                {
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                    'preferredquality': '192',
-                }
-            ],
-            'logger': app.logger,
-            'nocheckcertificate': True,
-        }
-
-        def push_event(name, data):
-            with queue_lock:
-                event_queue.append(sse_event(name, data))
-
-        def progress_hook(d):
-            try:
-                status = d.get('status')
-                if status == 'downloading':
-                    total = d.get('total_bytes') or d.get('total_bytes_estimate') or 0
-                    downloaded = d.get('downloaded_bytes') or 0
-                    percent = (downloaded / total * 100) if total else None
-                    evt = {
-                        'status': 'downloading',
-                        'percent': percent,
-                        'speed': d.get('speed'),
-                        'eta': d.get('eta'),
-                        'filename': d.get('filename')
-                    }
-                    push_event('progress', evt)
-                elif status == 'finished':
-                    push_event('progress', {'status': 'download finished, converting...'})
-            except Exception:
-                app.logger.exception("progress_hook error")
+    # join a running download of the same url, or start a new one
+    key = flight_key(url, want_mp3)
+    with JOB_LOCK:
+        flight = IN_FLIGHT.get(key) if key else None
+        start_worker = flight is None
+        if start_worker:
+            if not JOB_SEM.acquire(blocking=False):
+                return jsonify({'error': 'server busy'}), 503, {'Retry-After': str(BUSY_RETRY_AFTER)}
+            flight = new_flight()
+            if key:
+                IN_FLIGHT[key] = flight
+        subq = subscribe(flight)
+
+    if start_worker:
+        # the worker owns the JOB_SEM slot from here on
+        try:
+            submit_job(run_download, flight, key, url, want_mp3)
+        except Exception:
+            app.logger.exception("couldn't start download worker")
+            # undo: free the slot, retire the flight and fail anyone who joined it
+            with JOB_LOCK:
+                IN_FLIGHT.pop(key, None)
+            JOB_SEM.release()
+            flight['result']['error'] = 'could not start download'
+            flight['done_evt'].set()
+            for other in list(flight['subscribers']):
+                other.put(None)
+            return jsonify({'error': 'could not start download'}), 500
 
-        def run_download():
-            try:
-                with YoutubeDL(dict(ydl_opts_base, progress_hooks=[progress_hook])) as ydl:
-                    info = ydl.extract_info(url, download=True)
-
-                    # Prepare final deliverable
-                    if 'entries' in info and info['entries']:
-                        playlist_title = sanitize_filename(info.get('title') or 'playlist')
-                        zip_path = os.path.join(tempdir, f"{playlist_title}.zip")
-                        with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_DEFLATED) as zipf:
-                            for entry in info['entries']:
-                                if not entry:
-                                    continue
-                                entry_title = sanitize_filename(entry.get('title') or entry.get('id') or 'untitled')
-                                mp3_filename = os.path.join(tempdir, f"{entry_title}.mp3")
-                                if os.path.exists(mp3_filename):
-                                    zipf.write(mp3_filename, arcname=f"{entry_title}.mp3")
-                                else:
-                                    for fname in os.listdir(tempdir):
-                                        if fname.lower().endswith('.mp3'):
-                                            if (entry.get('id') and entry['id'] in fname) or (entry_title in fname):
-                                                zipf.write(os.path.join(tempdir, fname), arcname=fname)
-                                                break
-                        final_path = zip_path
-                        final_name = f"{playlist_title}.zip"
-                    else:
-                        title = sanitize_filename(info.get('title') or info.get('id') or 'video')
-                        mp3_path = os.path.join(tempdir, f"{title}.mp3")
-                        if not os.path.exists(mp3_path):
-                            mp3s = [f for f in os.listdir(tempdir) if f.lower().endswith('.mp3')]
-                            if len(mp3s) == 1:
-                                mp3_path = os.path.join(tempdir, mp3s[0])
-                            elif len(mp3s) > 1:
-                                match = next((f for f in mp3s if title in f), mp3s[0])
-                                mp3_path = os.path.join(tempdir, match)
-                            else:
-                                raise RuntimeError("expected mp3 file not found after download")
-                        final_path = mp3_path
-                        final_name = os.path.basename(mp3_path)
-
-                    # register job
-                    with JOB_LOCK:
-                        JOBS[token] = {'path': final_path, 'filename': final_name, 'expires_at': now() + AUTO_CLEANUP_SECONDS}
-                    schedule_job_cleanup(token)
-
-                    result['success'] = True
-                    result['final_path'] = final_path
-                    result['final_name'] = final_name
-
-            except Exception as exc:
-                app.logger.exception("SSE download error")
-                result['error'] = str(exc)
-            finally:
-                finished['done'] = True
-                # Ensure at least one event gets pushed so generate loop can observe finished state
-                push_event('progress', {'status': 'worker finished'})
-
-        # start background worker
-        worker = threading.Thread(target=run_download, daemon=True)
-        worker.start()
-
-        # stream events while worker runs and until queue drained
+    def generate():
+        done_evt = flight['done_evt']
         try:
-            while not finished['done'] or event_queue:
-                # flush queue
-                to_yield = None
-                with queue_lock:
-                    if event_queue:
-                        # pop first event
-                        to_yield = event_queue.pop(0)
-                if to_yield:
-                    yield to_yield
-                else:
+            # stream events while worker runs and until queue drained
+            while not done_evt.is_set() or not subq.empty():
+                try:
+                    to_yield = subq.get(timeout=15)
+                except queue.Empty:
                     # keep-alive comment to prevent some proxies closing connection
-                    yield ": keep-alive\n\n"
-                    time.sleep(0.25)
+                    yield b": keep-alive\n\n"
+                    continue
+                if to_yield is not None:
+                    yield to_yield
 
             # worker finished; check result
+            result = flight['result']
             if result['success']:
-                yield sse_event('done', {'token': token, 'filename': result['final_name']})
+                yield sse_event('done', {'token': flight['token'], 'filename': result['final_name']})
             else:
                 yield sse_event('error', {'error': result['error'] or 'unknown error'})
-                # cleanup tempdir on failure
-                try:
-                    shutil.rmtree(tempdir, ignore_errors=True)
-                except Exception:
-                    pass
 
         except GeneratorExit:
             # client disconnected
@@ -439,6 +1065,11 @@ def progress_sse():
                 yield sse_event('error', {'error': 'internal server error in progress stream'})
             except Exception:
                 pass
+        finally:
+            if not done_evt.is_set():
+                with JOB_LOCK:
+                    if subq in flight['subscribers']:
+                        flight['subscribers'].remove(subq)
 
     return Response(stream_with_context(generate()), mimetype='text/event-stream')
 
@@ -448,27 +1079,37 @@ def progress_sse():
 # -----------------------
 @app.route('/download/<token>')
 def download_token(token):
+    # a deduplicated job is shared by several SSE clients; each may download once
     with JOB_LOCK:
-        job = JOBS.pop(token, None)
+        job = JOBS.get(token)
+        if job:
+            job['refs'] -= 1
+            job['active'] += 1
+            if job['refs'] <= 0:
+                JOBS.pop(token, None)
 
     if not job:
         return jsonify({'error': 'invalid or expired token'}), 404
 
+    def finish_download():
+        # True once the last client's download is done with the files
+        with JOB_LOCK:
+            job['active'] -= 1
+            return job['refs'] <= 0 and job['active'] <= 0
+
     filepath = job['path']
     filename = job.get('filename') or os.path.basename(filepath)
 
     try:
         @after_this_request
         def remove_file(response):
-            try:
-                shutil.rmtree(os.path.dirname(filepath), ignore_errors=True)
-            except Exception:
-                app.logger.exception("cleanup after download failed")
-            return response
+            return cleanup_after(response, job['dir'], finish_download)
     except Exception:
         app.logger.exception("couldn't register after_this_request cleanup")
 
-    return send_file(filepath, as_attachment=True, download_name=filename)
+    if job.get('is_playlist') and not filepath:
+        return zip_response(job['files'], filename)
+    return file_response(filepath, filename)
 
 
 # -----------------------
@@ -490,84 +1131,48 @@ def fetch():
     if not is_youtube_url(url):
         return jsonify({'error': 'unsupported url domain'}), 400
 
-    tempdir = tempfile.mkdtemp(prefix='ydl_')
+    want_mp3 = parse_want_mp3(request.args.get('format'))
+    if want_mp3 is None:
+        return jsonify({'error': 'unsupported format (use mp3 or m4a)'}), 400
+
+    if not JOB_SEM.acquire(blocking=False):
+        return jsonify({'error': 'server busy'}), 503, {'Retry-After': str(BUSY_RETRY_AFTER)}
+
+    tempdir = None
 
     @after_this_request
     def cleanup(response):
-        try:
-            shutil.rmtree(tempdir)
-        except Exception as e:
-            app.logger.error("cleanup error: %s", e)
+        if tempdir:
+            cleanup_after(response, tempdir)
         return response
 
-    ydl_opts = {
-        'format': 'bestaudio/best',
-        'outtmpl': os.path.join(tempdir, '%(title)s.%(ext)s'),
-        'quiet': True,
-        'no_warnings': True,
-        'postprocessors': [
-            {
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            }
-        ],
-        'logger': app.logger,
-        'nocheckcertificate': True,
-    }
-
     try:
-        with YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-
-            if 'entries' in info and info['entries']:
-                playlist_title = sanitize_filename(info.get('title') or 'playlist')
-                zip_path = os.path.join(tempdir, f"{playlist_title}.zip")
-                with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_DEFLATED) as zipf:
-                    for entry in info['entries']:
-                        if not entry:
-                            continue
-                        entry_title = sanitize_filename(entry.get('title') or entry.get('id') or 'untitled')
-                        mp3_filename = os.path.join(tempdir, f"{entry_title}.mp3")
-                        if os.path.exists(mp3_filename):
-                            zipf.write(mp3_filename, arcname=f"{entry_title}.mp3")
-                        else:
-                            for fname in os.listdir(tempdir):
-                                if fname.lower().endswith('.mp3'):
-                                    if (entry.get('id') and entry['id'] in fname) or (entry_title in fname):
-                                        zipf.write(os.path.join(tempdir, fname), arcname=fname)
-                                        break
-                return send_file(
-                    zip_path,
-                    as_attachment=True,
-                    download_name=f"{playlist_title}.zip",
-                    mimetype='application/zip'
-                )
-
-            else:
-                title = sanitize_filename(info.get('title') or info.get('id') or 'video')
-                mp3_path = os.path.join(tempdir, f"{title}.mp3")
-                if not os.path.exists(mp3_path):
-                    mp3s = [f for f in os.listdir(tempdir) if f.lower().endswith('.mp3')]
-                    if len(mp3s) == 1:
-                        mp3_path = os.path.join(tempdir, mp3s[0])
-                    elif len(mp3s) > 1:
-                        match = next((f for f in mp3s if title in f), mp3s[0])
-                        mp3_path = os.path.join(tempdir, match)
-                    else:
-                        raise RuntimeError("expected mp3 file not found after download")
-
-                return send_file(
-                    mp3_path,
-                    as_attachment=True,
-                    download_name=f"{title}.mp3",
-                    mimetype='audio/mpeg'
-                )
+        tempdir = make_workdir()
+        info, files = download_audio(url, tempdir, want_mp3)
+
+        if info.get('_type') == 'playlist':
+            playlist_title = sanitize_filename(info.get('title') or 'playlist')
+            zip_name = f"{playlist_title}.zip"
+            zip_path = prebuilt_zip(tempdir, files, zip_name)
+            if zip_path:
+                return file_response(zip_path, zip_name)
+            return zip_response(files, zip_name)
+
+        else:
+            mp3_path = files[0]
+            return file_response(
+                mp3_path,
+                os.path.basename(mp3_path),
+                mimetype='audio/mpeg' if want_mp3 else None
+            )
 
     except Exception as e:
-        shutil.rmtree(tempdir, ignore_errors=True)
+        if tempdir:
+            remove_workdir(tempdir)
         app.logger.exception("download error")
         return jsonify({'error': str(e)}), 500
+    finally:
+        JOB_SEM.release()
 
 
 # -----------------------
@@ -575,8 +1180,13 @@ def fetch():
 # -----------------------
 @app.route('/')
 def index():
-    return render_template_string(HTML_PAGE)
+    headers = {'ETag': f'"{_INDEX_ETAG}"', 'Cache-Control': 'public, max-age=3600'}
+    if _INDEX_ETAG in request.if_none_match:
+        return Response(status=304, headers=headers)
+    return Response(_INDEX_BODY, mimetype='text/html', headers=headers)
 
 
 if __name__ == '__main__':
+    # Development server. In production run under gunicorn's gevent worker
+    # (see Procfile) so idle SSE streams don't each pin a worker.
     app.run(host='0.0.0.0', port=5000, debug=False)